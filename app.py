@@ -1,14 +1,29 @@
 from flask import *
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import pandas as pd
 import os
 import zipfile
 from io import BytesIO
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, has_request_context
 import uuid
 import json
 import smtplib
 from email.message import EmailMessage
+from concurrent.futures import Future
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import math
+import threading
+import hashlib
+import time
+import mimetypes
+import tempfile
+from werkzeug.utils import safe_join
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock; fall back to in-process locking only
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your_secret_key_here_change_in_production')  # Required for flash messages
@@ -42,82 +57,474 @@ except (OSError, PermissionError) as e:
 
 VALID_PASSWORD = "kuce&t"
 
+# Roster columns that select a template/signature profile per row. Columns such as
+# department are often printed on the certificate, so only an explicit column selects one.
+PROFILE_COLUMNS = ['profile']
+
+# Shared render workers, serving every user's queued rows in turn
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+render_queues = OrderedDict()
+render_queue_condition = threading.Condition()
+queued_rows = 0
+
+# Admission control: batches beyond these limits get HTTP 429 with a Retry-After hint
+MAX_ACTIVE_BATCHES = int(os.environ.get('MAX_ACTIVE_BATCHES', 4))
+MAX_BATCHES_PER_USER = int(os.environ.get('MAX_BATCHES_PER_USER', 1))
+MAX_QUEUED_ROWS = int(os.environ.get('MAX_QUEUED_ROWS', 5000))
+active_batches = {}
+row_render_seconds = 0.2  # Moving average, used to estimate queue wait times
+
+# Serializes writes to shared files between threads (flock covers other processes)
+file_write_lock = threading.Lock()
+
+# How long browsers may reuse a served certificate before revalidating its ETag
+CERTIFICATE_MAX_AGE = int(os.environ.get('CERTIFICATE_MAX_AGE', 3600))
+
+# Reusable full-size canvases, bounded by RENDER_MEMORY_MB. Each worker draws on one canvas
+# at a time, so the default leaves room for one A4 300 dpi canvas (about 35 MB) per worker.
+RENDER_MEMORY_BUDGET = int(os.environ.get('RENDER_MEMORY_MB', RENDER_WORKERS * 35)) * 1024 * 1024
+idle_canvases = {}
+canvas_memory = 0
+canvas_condition = threading.Condition()
+
+# Fonts are not shared between render threads
+font_cache = threading.local()
+
+# Rasterized text/glyph masks and text measurements, bounded by TEXT_CACHE_MB
+TEXT_CACHE_BUDGET = int(os.environ.get('TEXT_CACHE_MB', 64)) * 1024 * 1024
+text_cache = OrderedDict()
+text_cache_bytes = 0
+text_cache_lock = threading.Lock()
+
+# Smallest font size auto-fit fields shrink to before letting text overflow their box
+MIN_AUTOFIT_FONT_SIZE = 8
+
+def get_user_id():
+    """Identify the current browser session, for fair scheduling and per-user layouts"""
+    if not has_request_context():
+        return 'anonymous'
+    if 'user_id' not in session:
+        session['user_id'] = str(uuid.uuid4())
+    return session['user_id']
+
+def submit_render(user_id, fn, *args):
+    """Queue a render task for a user and return a Future for its result"""
+    global queued_rows
+    future = Future()
+    with render_queue_condition:
+        render_queues.setdefault(user_id, deque()).append((future, fn, args))
+        queued_rows += 1
+        render_queue_condition.notify()
+    return future
+
+def render_worker():
+    """Run queued render tasks, taking one task from each waiting user in turn.
+
+    A user with a large batch therefore cannot hold up a user with a small one.
+    """
+    global queued_rows, row_render_seconds
+    while True:
+        with render_queue_condition:
+            while not render_queues:
+                render_queue_condition.wait()
+            user_id, tasks = next(iter(render_queues.items()))
+            future, fn, args = tasks.popleft()
+            if tasks:
+                render_queues.move_to_end(user_id)
+            else:
+                del render_queues[user_id]
+            queued_rows -= 1
+
+        if not future.set_running_or_notify_cancel():
+            continue
+        started = time.perf_counter()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        row_render_seconds = 0.9 * row_render_seconds + 0.1 * (time.perf_counter() - started)
+
+def admit_batch(user_id, rows):
+    """Reserve room for a user's batch.
+
+    Returns None when the batch may start, otherwise the number of seconds to wait before
+    retrying. Every admitted batch must be released with finish_batch.
+    """
+    with render_queue_condition:
+        saturated = (
+            active_batches.get(user_id, 0) >= MAX_BATCHES_PER_USER
+            or sum(active_batches.values()) >= MAX_ACTIVE_BATCHES
+            or (queued_rows and queued_rows + rows > MAX_QUEUED_ROWS)
+        )
+        if saturated:
+            return max(1, math.ceil(queued_rows * row_render_seconds / RENDER_WORKERS))
+        active_batches[user_id] = active_batches.get(user_id, 0) + 1
+        return None
+
+def finish_batch(user_id):
+    """Release the room reserved by admit_batch, and the idle canvases once no batch is left"""
+    with render_queue_condition:
+        active_batches[user_id] -= 1
+        if not active_batches[user_id]:
+            del active_batches[user_id]
+        idle = not active_batches
+    if idle:
+        drop_idle_canvases()
+
+@contextmanager
+def locked_file(path):
+    """Hold an exclusive lock on path across threads and gunicorn worker processes"""
+    with file_write_lock:
+        with open(path + '.lock', 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def write_json_atomically(path, data):
+    """Write JSON so that readers never see a half-written file"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with locked_file(path):
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, path)
+
 def get_font_path(font_name):
     """Get the full path to a font file"""
     return os.path.join(FONTS_FOLDER, font_name)
 
-def add_text_to_image(image, text, position, font_size=36, font_name="DancingScript-Regular.ttf", color=(0, 0, 0), max_width_ratio=0.8, line_spacing=1.2):
+def load_font(font_name, font_size):
+    """Load a font, falling back to the default font. Fonts are cached per thread."""
+    fonts = getattr(font_cache, 'fonts', None)
+    if fonts is None:
+        fonts = font_cache.fonts = {}
+    key = (font_name, font_size)
+    if key not in fonts:
+        font_path = get_font_path(font_name)
+        if os.path.exists(font_path):
+            try:
+                fonts[key] = ImageFont.truetype(font_path, font_size)
+            except Exception as e:
+                print(f"Error loading font {font_name}: {e}")
+                fonts[key] = ImageFont.load_default()
+        else:
+            print(f"Font file not found: {font_path}")
+            fonts[key] = ImageFont.load_default()
+    return fonts[key]
+
+def get_cached_text(key):
+    """Look up a cached text mask or measurement, marking it as recently used"""
+    with text_cache_lock:
+        entry = text_cache.get(key)
+        if entry is not None:
+            text_cache.move_to_end(key)
+        return entry
+
+def put_cached_text(key, entry, size):
+    """Cache a text mask or measurement, evicting the least recently used entries over budget"""
+    global text_cache_bytes
+    if size > TEXT_CACHE_BUDGET:
+        return
+    with text_cache_lock:
+        if key in text_cache:
+            return
+        text_cache[key] = (entry, size)
+        text_cache_bytes += size
+        while text_cache_bytes > TEXT_CACHE_BUDGET:
+            _, (_, evicted_size) = text_cache.popitem(last=False)
+            text_cache_bytes -= evicted_size
+
+def get_text_bbox(font, font_key, text):
+    """Measure text like draw.textbbox at (0, 0), measuring each string only once"""
+    key = ('bbox', font_key, text)
+    cached = get_cached_text(key)
+    if cached is not None:
+        return cached[0]
+    bbox = font.getbbox(text)
+    put_cached_text(key, bbox, 64)
+    return bbox
+
+def get_text_length(font, font_key, text):
+    """Measure the advance of a glyph or glyph pair, measuring each only once"""
+    key = ('length', font_key, text)
+    cached = get_cached_text(key)
+    if cached is not None:
+        return cached[0]
+    length = font.getlength(text)
+    put_cached_text(key, length, 64)
+    return length
+
+def rasterize_text(font, text):
+    """Rasterize text into an alpha mask. Returns (mask, (x_offset, y_offset))"""
+    bbox = font.getbbox(text)
+    mask = Image.new('L', (max(bbox[2] - bbox[0], 1), max(bbox[3] - bbox[1], 1)), 0)
+    ImageDraw.Draw(mask).text((-bbox[0], -bbox[1]), text, font=font, fill=255)
+    return mask, (bbox[0], bbox[1])
+
+def get_kerning(font, font_key, previous, char):
+    """Kerning between a glyph pair: whatever the pair adds over the single glyphs"""
+    return (get_text_length(font, font_key, previous + char)
+            - get_text_length(font, font_key, previous)
+            - get_text_length(font, font_key, char))
+
+def get_glyph_positions(font, font_key, line):
+    """Place the visible glyphs of a line at the pen positions FreeType uses (advances plus kerning).
+
+    Returns (positions, advance) where positions is a list of (char, x) with x rounded to
+    whole pixels and advance is where the pen ends up.
+    """
+    positions = []
+    pen_x = 0.0
+    previous = None
+    for char in line:
+        if previous is not None:
+            pen_x += get_kerning(font, font_key, previous, char)
+        if not char.isspace():
+            positions.append((char, int(pen_x + 0.5)))
+        pen_x += get_text_length(font, font_key, char)
+        previous = char
+    return positions, pen_x
+
+def get_word_metrics(font, font_key, word):
+    """Measure a word from its glyph boxes, measuring each word only once.
+
+    Returns (bbox or None, advance, space_before, space_after) where the spacing is the
+    kerning against a preceding space, and the kerned space that follows the word.
+    """
+    key = ('word', font_key, word)
+    cached = get_cached_text(key)
+    if cached is not None:
+        return cached[0]
+    positions, advance = get_glyph_positions(font, font_key, word)
+    boxes = [(x + bbox[0], bbox[1], x + bbox[2], bbox[3])
+             for char, x in positions
+             for bbox in (get_text_bbox(font, font_key, char),)]
+    bbox = None
+    if boxes:
+        bbox = (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                max(box[2] for box in boxes), max(box[3] for box in boxes))
+    space_before = get_kerning(font, font_key, ' ', word[0])
+    space_after = get_kerning(font, font_key, word[-1], ' ') + get_text_length(font, font_key, ' ')
+    metrics = (bbox, advance, space_before, space_after)
+    put_cached_text(key, metrics, 64)
+    return metrics
+
+def estimate_text_bbox(font, font_key, text):
+    """Measure text from cached word measurements instead of measuring the whole string.
+
+    Agrees with get_text_bbox to within a pixel or so for fonts using basic layout, which
+    is close enough to search for a font size; other fonts are measured exactly.
+    """
+    if getattr(font, 'layout_engine', None) != ImageFont.Layout.BASIC:
+        return get_text_bbox(font, font_key, text)
+    boxes = []
+    pen_x = 0.0
+    space_after = None
+    for word in text.split(' '):
+        if not word:
+            # Repeated spaces, measured without kerning
+            pen_x += get_text_length(font, font_key, ' ')
+            continue
+        bbox, advance, space_before, word_space_after = get_word_metrics(font, font_key, word)
+        if space_after is not None:
+            # Words are joined by a single space, kerned against both neighbours
+            pen_x += space_after + space_before
+        if bbox is not None:
+            x = int(pen_x + 0.5)
+            boxes.append((x + bbox[0], bbox[1], x + bbox[2], bbox[3]))
+        pen_x += advance
+        space_after = word_space_after
+    if not boxes:
+        return get_text_bbox(font, font_key, text)
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+def get_text_mask(font, font_key, line):
+    """Get the alpha mask of a line of text, rasterizing each line and glyph only once.
+
+    Unseen lines are assembled from cached glyph masks placed at the same pen positions
+    FreeType uses (advances plus kerning). Fonts using complex layout may substitute
+    glyphs by context, so their lines are rasterized as a whole instead.
+    """
+    key = ('line', font_key, line)
+    cached = get_cached_text(key)
+    if cached is not None:
+        return cached[0]
+
+    if getattr(font, 'layout_engine', None) != ImageFont.Layout.BASIC:
+        entry = rasterize_text(font, line)
+    else:
+        glyphs = []
+        for char, pen_x in get_glyph_positions(font, font_key, line)[0]:
+            glyph_key = ('glyph', font_key, char)
+            glyph = get_cached_text(glyph_key)
+            if glyph is None:
+                glyph_entry = rasterize_text(font, char)
+                put_cached_text(glyph_key, glyph_entry, glyph_entry[0].size[0] * glyph_entry[0].size[1])
+            else:
+                glyph_entry = glyph[0]
+            glyph_mask, (glyph_x, glyph_y) = glyph_entry
+            glyphs.append((glyph_mask, pen_x + glyph_x, glyph_y))
+
+        if not glyphs:
+            entry = rasterize_text(font, line)
+        else:
+            left = min(x for _, x, _ in glyphs)
+            top = min(y for _, _, y in glyphs)
+            right = max(x + glyph_mask.size[0] for glyph_mask, x, _ in glyphs)
+            bottom = max(y + glyph_mask.size[1] for glyph_mask, _, y in glyphs)
+            mask = Image.new('L', (right - left, bottom - top), 0)
+            for glyph_mask, x, y in glyphs:
+                box = (x - left, y - top, x - left + glyph_mask.size[0], y - top + glyph_mask.size[1])
+                # Blend the coverage of overlapping glyphs (joined script letters) like Pillow does
+                mask.paste(ImageChops.screen(mask.crop(box), glyph_mask), box)
+            entry = (mask, (left, top))
+
+    put_cached_text(key, entry, entry[0].size[0] * entry[0].size[1])
+    return entry
+
+def layout_text(font, font_key, text, max_text_width, line_spacing=1.2, measure=get_text_bbox):
+    """Word-wrap text to max_text_width and measure it with measure (a get_text_bbox-like function).
+
+    Returns (lines, total_text_height) where lines is a list of (line, width, height).
+    """
+    # Prepare word-wrapped lines
+    words = str(text).split()
+    if not words:
+        return [], 0
+
+    lines = []
+    current_line = words[0]
+    for word in words[1:]:
+        test_line = current_line + " " + word
+        bbox = measure(font, font_key, test_line)
+        line_width = bbox[2] - bbox[0]
+        if line_width <= max_text_width:
+            current_line = test_line
+        else:
+            lines.append(current_line)
+            current_line = word
+    lines.append(current_line)
+
+    # Measure every line
+    measured_lines = []
+    for line in lines:
+        bbox = measure(font, font_key, line)
+        measured_lines.append((line, bbox[2] - bbox[0], bbox[3] - bbox[1]))
+
+    # Total height with spacing between lines
+    total_text_height = int(sum(height if i == 0 else height * line_spacing
+                                for i, (_, _, height) in enumerate(measured_lines)))
+    return measured_lines, total_text_height
+
+def text_fits_box(font_name, font_size, text, box, line_spacing=1.2, measure=get_text_bbox):
+    """Check whether text wrapped at font_size fits inside box (width, height)"""
+    font = load_font(font_name, font_size)
+    lines, total_text_height = layout_text(font, (font_name, font_size), text, box[0], line_spacing, measure)
+    return (max((width for _, width, _ in lines), default=0) <= box[0]
+            and total_text_height <= box[1])
+
+def fit_font_size(font_name, max_font_size, text, box, line_spacing=1.2):
+    """Find the largest font size up to max_font_size at which text fits inside box.
+
+    Sizes are binary searched using widths built from cached glyph measurements, which
+    are shared by every value drawn at that size. Larger sizes are estimated again where
+    the line breaks can move, those that nearly fit and the chosen size are measured
+    exactly, stepping down if the estimate was a pixel off; add_text_to_image reuses that
+    measurement. Falls back to MIN_AUTOFIT_FONT_SIZE when even that does not fit.
+    """
+    key = ('fit', font_name, max_font_size, box, line_spacing, text)
+    cached = get_cached_text(key)
+    if cached is not None:
+        return cached[0]
+
+    largest = max(max_font_size, MIN_AUTOFIT_FONT_SIZE)
+    low, high = MIN_AUTOFIT_FONT_SIZE, largest
+    if text_fits_box(font_name, high, text, box, line_spacing, estimate_text_bbox):
+        low = high
+    while low < high:
+        middle = (low + high + 1) // 2
+        if text_fits_box(font_name, middle, text, box, line_spacing, estimate_text_bbox):
+            low = middle
+        else:
+            high = middle - 1
+    # Wrapping makes fitting uneven: a larger size that moves a line break can end up with
+    # narrower lines or a shorter first line and fit again, and rounding can move a break
+    # back and forth over the next few sizes. Hinting also lets each line come out a pixel
+    # or two shorter at a larger size. So sizes above are estimated one by one around a
+    # break or while the text is within those pixels of the box, and otherwise skipped until
+    # a break can move. Sizes the estimate says nearly fit (it can be a pixel off) are
+    # measured exactly.
+    best = None
+    previous_breaks = None
+    size = low + 1
+    while size <= largest:
+        lines, total_text_height = layout_text(load_font(font_name, size), (font_name, size), text,
+                                               box[0], line_spacing, estimate_text_bbox)
+        breaks = [line for line, _, _ in lines]
+        widest = max((width for _, width, _ in lines), default=0)
+        if widest > box[0] + 2:
+            # A single word is wider than the box, and it only grows with the size
+            break
+        if total_text_height <= box[1] + 2 and text_fits_box(font_name, size, text, box, line_spacing):
+            best = size
+            size += 1
+        elif total_text_height <= box[1] + 2 * len(lines) or breaks != previous_breaks:
+            size += 1
+        else:
+            # Widths grow in proportion to the size, so no break moves before the widest
+            # line reaches the box width
+            size = max(size + 1, size * box[0] // max(widest, 1))
+        previous_breaks = breaks
+    if best is not None:
+        low = best
+    else:
+        while low > MIN_AUTOFIT_FONT_SIZE and not text_fits_box(font_name, low, text, box, line_spacing):
+            low -= 1
+
+    put_cached_text(key, low, 64)
+    return low
+
+def add_text_to_image(image, text, position, font_size=36, font_name="DancingScript-Regular.ttf", color=(0, 0, 0), max_width_ratio=0.8, line_spacing=1.2, fit_box=None):
     """Add text to an image at specified position with center alignment and automatic wrapping.
 
     The text will be wrapped to fit within max_width_ratio of the image width, with each line
     centered horizontally around the provided position. The entire block is vertically centered
-    on the given position as well.
+    on the given position as well. With fit_box (width, height), the text is instead wrapped to
+    the box width and drawn at the largest size up to font_size that fits in the box.
     """
     try:
         draw = ImageDraw.Draw(image)
 
+        # Shrink auto-fit text until it fits its box
+        if fit_box:
+            font_size = fit_font_size(font_name, font_size, str(text), fit_box, line_spacing)
+
         # Load font
-        font = None
-        font_path = get_font_path(font_name)
-        if os.path.exists(font_path):
-            try:
-                font = ImageFont.truetype(font_path, font_size)
-            except Exception as e:
-                print(f"Error loading font {font_name}: {e}")
-                font = ImageFont.load_default()
-        else:
-            print(f"Font file not found: {font_path}")
-            font = ImageFont.load_default()
+        font = load_font(font_name, font_size)
+        font_key = (font_name, font_size)
 
         # Compute max text width allowed
         image_width, image_height = image.size
-        max_text_width = int(image_width * max_width_ratio)
+        max_text_width = fit_box[0] if fit_box else int(image_width * max_width_ratio)
 
-        # Prepare word-wrapped lines
-        words = str(text).split()
-        if not words:
+        lines, total_text_height = layout_text(font, font_key, text, max_text_width, line_spacing)
+        if not lines:
             return image
 
-        lines = []
-        current_line = words[0]
-        for word in words[1:]:
-            test_line = current_line + " " + word
-            bbox = draw.textbbox((0, 0), test_line, font=font)
-            line_width = bbox[2] - bbox[0]
-            if line_width <= max_text_width:
-                current_line = test_line
-            else:
-                lines.append(current_line)
-                current_line = word
-        lines.append(current_line)
-
-        # Measure total height to vertically center block
-        line_heights = []
-        max_line_width = 0
-        for line in lines:
-            bbox = draw.textbbox((0, 0), line, font=font)
-            line_width = bbox[2] - bbox[0]
-            line_height = bbox[3] - bbox[1]
-            max_line_width = max(max_line_width, line_width)
-            line_heights.append(line_height)
-
-        # Total height with spacing between lines
-        if line_heights:
-            total_text_height = int(sum(line_heights[i] if i == 0 else line_heights[i] * line_spacing for i in range(len(line_heights))))
-        else:
-            total_text_height = 0
-
         # Start Y so that the block is centered at the provided position
         start_y = position[1] - total_text_height // 2
 
         # Draw each line centered horizontally at the given X
         current_y = start_y
-        for i, line in enumerate(lines):
-            bbox = draw.textbbox((0, 0), line, font=font)
-            line_width = bbox[2] - bbox[0]
-            line_height = bbox[3] - bbox[1]
+        for i, (line, line_width, line_height) in enumerate(lines):
             x = position[0] - line_width // 2
-            draw.text((x, current_y), line, font=font, fill=color)
+            mask, (offset_x, offset_y) = get_text_mask(font, font_key, line)
+            draw.bitmap((x + offset_x, current_y + offset_y), mask, fill=color)
             # Advance Y with spacing for next line
             increment = line_height if i == 0 else int(line_height * line_spacing)
             current_y += increment
@@ -127,20 +534,18 @@ def add_text_to_image(image, text, position, font_size=36, font_name="DancingScr
         print(f"Error adding text: {e}")
         return image
 
-def add_signature_to_image(image, signature_image, position_type="bottom_right", custom_x=None, custom_y=None, size_percentage=20):
-    """Add signature to an image at specified position"""
+def resize_signature(signature_image, size_percentage=20):
+    """Scale a signature image to a percentage of its original size"""
+    original_width, original_height = signature_image.size
+    new_width = int(original_width * size_percentage / 100)
+    new_height = int(original_height * size_percentage / 100)
+    return signature_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+def paste_signature(image, signature_resized, position_type="bottom_right", custom_x=None, custom_y=None):
+    """Paste an already resized signature onto an image at specified position"""
     try:
-        if signature_image is None:
-            return image
-            
-        # Calculate signature size
-        original_width, original_height = signature_image.size
-        new_width = int(original_width * size_percentage / 100)
-        new_height = int(original_height * size_percentage / 100)
-        
-        # Resize signature
-        signature_resized = signature_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
+        new_width, new_height = signature_resized.size
+
         # Calculate position
         template_width, template_height = image.size
         
@@ -178,6 +583,19 @@ def add_signature_to_image(image, signature_image, position_type="bottom_right",
         print(f"Error adding signature: {e}")
         return image
 
+def add_signature_to_image(image, signature_image, position_type="bottom_right", custom_x=None, custom_y=None, size_percentage=20):
+    """Add signature to an image at specified position"""
+    try:
+        if signature_image is None:
+            return image
+            
+        # Resize signature
+        signature_resized = resize_signature(signature_image, size_percentage)
+        return paste_signature(image, signature_resized, position_type, custom_x, custom_y)
+    except Exception as e:
+        print(f"Error adding signature: {e}")
+        return image
+
 def calculate_text_position(template_width, template_height, field_type, field_index=0, layout_config=None):
     """Calculate optimal text position based on field type and template dimensions"""
     
@@ -285,6 +703,888 @@ def get_field_type(column_name):
     else:
         return 'default'
 
+def read_data_file(data_file, file_extension):
+    """Read a CSV or Excel data file into a DataFrame"""
+    if file_extension == '.csv':
+        return pd.read_csv(data_file)
+    return pd.read_excel(data_file)
+
+def get_layout_file_path(user_id=None):
+    """Get the path of the saved layout file, shared or for one user"""
+    # On Vercel, use /tmp for writable files; otherwise use static/uploads
+    uploads_folder = '/tmp' if IS_VERCEL else 'static/uploads'
+    if user_id is None:
+        return os.path.join(uploads_folder, 'layout.json')
+    return os.path.join(uploads_folder, 'layouts', f"{sanitize_filename(user_id)}.json")
+
+def get_saved_layout_file_path():
+    """Get the layout file in use: this user's own saved layout, or the shared one.
+
+    Each user's own saved layout is used when there is one, so coordinators working at the
+    same time do not overwrite each other's layout.
+    """
+    layout_file_path = get_layout_file_path(get_user_id())
+    if not os.path.exists(layout_file_path):
+        layout_file_path = get_layout_file_path()
+    return layout_file_path
+
+def load_saved_layout():
+    """Load the layout saved by the position editor, or an empty layout"""
+    layout_file_path = get_saved_layout_file_path()
+    if os.path.exists(layout_file_path):
+        try:
+            with open(layout_file_path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading layout file: {e}")
+    return {}
+
+def load_template_image(template_file):
+    """Open a template image and convert it to RGB mode to avoid RGBA issues when saving as JPEG"""
+    return flatten_to_rgb(Image.open(template_file))
+
+def flatten_to_rgb(template):
+    """Convert an image to RGB, placing transparent images on a white background"""
+    if template.mode == 'RGBA':
+        # Create a white background
+        background = Image.new('RGB', template.size, (255, 255, 255))
+        background.paste(template, mask=template.split()[-1])  # Use alpha channel as mask
+        template = background
+    elif template.mode != 'RGB':
+        template = template.convert('RGB')
+    return template
+
+def load_signature_image(signature_file):
+    """Open a signature image as RGBA, or return None if it cannot be read"""
+    try:
+        signature_image = Image.open(signature_file)
+        # Convert to RGBA to handle transparency
+        if signature_image.mode != 'RGBA':
+            signature_image = signature_image.convert('RGBA')
+        return signature_image
+    except Exception as e:
+        print(f"Error loading signature {signature_file}: {e}")
+        return None
+
+def get_student_name(row):
+    """Find the student name in a data row"""
+    for field_name in row.index:
+        if any(word in field_name.lower() for word in ['name', 'full_name', 'participant', 'student', 'attendee']):
+            return str(row[field_name])
+    return "Unknown"
+
+def get_profiles_file_path():
+    """Get the path of the template/signature profiles file"""
+    return '/tmp/profiles.json' if IS_VERCEL else 'static/uploads/profiles.json'
+
+def load_profiles():
+    """Load the named template/signature profiles, or an empty mapping"""
+    profiles_file_path = get_profiles_file_path()
+    if os.path.exists(profiles_file_path):
+        try:
+            with open(profiles_file_path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading profiles file: {e}")
+    return {}
+
+def get_profile_column(df):
+    """Find the data column that selects a template/signature profile for each row"""
+    for col in df.columns:
+        if str(col).strip().lower() in PROFILE_COLUMNS:
+            return col
+    return None
+
+def prepare_profile(template, signature_images, signature_sizes, saved_layout):
+    """Prepare everything that is shared by all certificates rendered from one template.
+
+    The template is decoded, signatures are resized and canvas coordinates are converted
+    to image coordinates once, so rendering a row only has to copy the template and draw.
+    The template is made RGB here; text and signatures are drawn without changing the
+    mode, so certificates never need converting before they are saved as JPEG.
+    """
+    template.load()
+    if template.mode != 'RGB':
+        template = flatten_to_rgb(template)
+    template_width, template_height = template.size
+
+    # Convert canvas coordinates to image coordinates
+    text_fields = []
+    for field_name, position in saved_layout.items():
+        x = int(position[0] * template_width / 1000)  # canvas width is 1000
+        y = int(position[1] * template_height / 700)  # canvas height is 700
+        # [x, y, width, height] marks an auto-fit field with a box centered on (x, y)
+        box = None
+        if len(position) >= 4 and position[2] and position[3]:
+            box = (max(int(position[2] * template_width / 1000), 1),
+                   max(int(position[3] * template_height / 700), 1))
+        text_fields.append((field_name, (x, y), box))
+
+    signature_placements = []
+    for sig_key, sig_image in signature_images.items():
+        if not sig_image:
+            continue
+
+        # Handle new signature placement logic
+        # Look for all positions where this signature should be placed
+        signature_positions = []
+
+        # Check for new naming convention (signature1_pos1, signature1_pos2, etc.)
+        sig_number = sig_key.replace('signature', '')
+        for layout_key, position in saved_layout.items():
+            if layout_key.startswith(f'signature{sig_number}_pos'):
+                signature_positions.append(position)
+
+        # Legacy support: check for old naming convention
+        if not signature_positions:
+            if sig_key in saved_layout:
+                signature_positions.append(saved_layout[sig_key])
+            elif sig_key == 'signature1' and 'signature' in saved_layout:
+                signature_positions.append(saved_layout['signature'])
+
+        if not signature_positions:
+            continue
+
+        # Resize once for every certificate using this signature
+        signature_resized = resize_signature(sig_image, signature_sizes.get(sig_key, 20))
+        for position in signature_positions:
+            signature_x = int(position[0] * template_width / 1000)
+            signature_y = int(position[1] * template_height / 700)
+            signature_placements.append((signature_resized, signature_x, signature_y))
+
+    # Identify everything about this profile that affects rendered pixels
+    fingerprint = hashlib.sha1()
+    fingerprint.update(repr((template.mode, template.size, text_fields)).encode())
+    fingerprint.update(template.tobytes())
+    for signature_resized, signature_x, signature_y in signature_placements:
+        fingerprint.update(repr((signature_resized.size, signature_x, signature_y)).encode())
+        fingerprint.update(signature_resized.tobytes())
+
+    return {
+        'template': template,
+        'text_fields': text_fields,
+        'signature_placements': signature_placements,
+        'fingerprint': fingerprint.hexdigest()
+    }
+
+def load_profile(profile_config, saved_layout):
+    """Load and prepare a named profile from its configuration"""
+    template = load_template_image(profile_config['template'])
+    signature_images = {}
+    for sig_key, signature_path in profile_config.get('signatures', {}).items():
+        signature_images[sig_key] = load_signature_image(signature_path)
+    return prepare_profile(
+        template,
+        signature_images,
+        profile_config.get('signature_sizes', {}),
+        profile_config.get('layout', saved_layout)
+    )
+
+def snapshot_profiles(df, profile_configs, session_folder, session_id):
+    """Copy the profiles a batch uses, with their template and signature files, into its folder.
+
+    Failed rows are rendered again from this snapshot, so editing profiles.json or a profile's
+    images in the meantime cannot change them. Returns the snapshot's filename.
+    """
+    import shutil
+    profile_column = get_profile_column(df) if profile_configs else None
+    used_values = set()
+    if profile_column is not None:
+        used_values = set(df[profile_column].fillna('').astype(str).str.strip())
+
+    snapshot = {}
+    for number, (value, profile_config) in enumerate(profile_configs.items()):
+        if value not in used_values:
+            continue
+        profile_config = dict(profile_config)
+        paths = [('template', profile_config.get('template'))]
+        paths += [(sig_key, path) for sig_key, path in profile_config.get('signatures', {}).items()]
+        copies = {}
+        for file_key, path in paths:
+            if not path:
+                continue
+            copy_path = os.path.join(session_folder, f"profile{number}_{file_key}_{session_id}{os.path.splitext(path)[1]}")
+            try:
+                shutil.copyfile(path, copy_path)
+                copies[file_key] = copy_path
+            except OSError as e:
+                # Keep the original path, so the retry reports the same problem
+                print(f"Error copying {path} for profile {value}: {e}")
+        if 'template' in copies:
+            profile_config['template'] = copies['template']
+        profile_config['signatures'] = {sig_key: copies.get(sig_key, path)
+                                        for sig_key, path in profile_config.get('signatures', {}).items()}
+        snapshot[value] = profile_config
+
+    profiles_filename = f"profiles_{session_id}.json"
+    with open(os.path.join(session_folder, profiles_filename), 'w') as f:
+        json.dump(snapshot, f)
+    return profiles_filename
+
+def get_row_profiles(df, default_profile, saved_layout, profile_configs=None):
+    """Pick the prepared profile for every row, loading each named profile only once.
+
+    Rows use the uploaded template and signatures when no profiles are configured, when
+    the roster has no profile column, or when their profile value is empty. So do rows whose
+    value names no configured profile, or a profile that failed to load; those are returned
+    so they can be reported.
+
+    Profiles come from profile_configs when given, otherwise from profiles.json.
+
+    Returns (row_profiles, profile_issues) where profile_issues has 'unmatched' and 'failed'
+    lists of {'profile', 'rows'} entries ('failed' entries also have an 'error').
+    """
+    profile_issues = {'unmatched': [], 'failed': []}
+    if profile_configs is None:
+        profile_configs = load_profiles()
+    profile_column = get_profile_column(df) if profile_configs else None
+    if profile_column is None:
+        return [default_profile] * len(df), profile_issues
+
+    prepared = {}
+    issues = {}
+    row_profiles = []
+    values = df[profile_column].fillna('').astype(str).str.strip()
+    for idx, value in values.items():
+        if value not in prepared:
+            prepared[value] = default_profile
+            if value in profile_configs:
+                try:
+                    prepared[value] = load_profile(profile_configs[value], saved_layout)
+                except Exception as e:
+                    print(f"Error loading profile {value}: {e}")
+                    issues[value] = {'profile': value, 'rows': [], 'error': str(e)}
+                    profile_issues['failed'].append(issues[value])
+            elif value and value.lower() != 'none':
+                issues[value] = {'profile': value, 'rows': []}
+                profile_issues['unmatched'].append(issues[value])
+        if value in issues:
+            issues[value]['rows'].append(int(idx) + 1)
+        row_profiles.append(prepared[value])
+    return row_profiles, profile_issues
+
+def count_profile_fallback_rows(profile_issues):
+    """Count the rows that used the uploaded template because of an unknown or broken profile"""
+    return sum(len(issue['rows']) for issues in (profile_issues or {}).values() for issue in issues)
+
+def describe_profile_issues(profile_issues):
+    """Describe rows that fell back to the uploaded template, one message per profile value"""
+    messages = []
+    for issue in (profile_issues or {}).get('unmatched', []):
+        messages.append(f"Profile \"{issue['profile']}\" is not configured, so {len(issue['rows'])} rows "
+                        f"used the uploaded template (rows {', '.join(map(str, issue['rows'][:10]))}).")
+    for issue in (profile_issues or {}).get('failed', []):
+        messages.append(f"Profile \"{issue['profile']}\" failed to load ({issue['error']}), so {len(issue['rows'])} rows "
+                        f"used the uploaded template (rows {', '.join(map(str, issue['rows'][:10]))}).")
+    return messages
+
+def acquire_canvas(template):
+    """Take a canvas from the shared pool and restore it to the template in place.
+
+    New canvases are only allocated while all canvases fit in RENDER_MEMORY_MB; idle
+    canvases of other sizes are dropped to make room, otherwise this waits for a canvas
+    to be released. A single canvas larger than the budget is allowed when no other
+    canvas exists.
+    """
+    global canvas_memory
+    key = (template.mode, template.size)
+    needed = get_canvas_bytes(*key)
+    canvas = None
+    with canvas_condition:
+        while True:
+            if idle_canvases.get(key):
+                canvas = idle_canvases[key].pop()
+                break
+            for other_key, pool in idle_canvases.items():
+                while pool and canvas_memory + needed > RENDER_MEMORY_BUDGET:
+                    pool.pop()
+                    canvas_memory -= get_canvas_bytes(*other_key)
+            if canvas_memory + needed <= RENDER_MEMORY_BUDGET or canvas_memory == 0:
+                canvas_memory += needed
+                break
+            canvas_condition.wait()
+
+    if canvas is None:
+        return template.copy()
+    canvas.paste(template)
+    return canvas
+
+def release_canvas(canvas):
+    """Return a canvas to the shared pool for the next certificate"""
+    with canvas_condition:
+        idle_canvases.setdefault((canvas.mode, canvas.size), []).append(canvas)
+        canvas_condition.notify()
+
+def drop_idle_canvases():
+    """Free every idle canvas, so an idle server does not keep its render memory"""
+    global canvas_memory
+    with canvas_condition:
+        for key, pool in idle_canvases.items():
+            canvas_memory -= get_canvas_bytes(*key) * len(pool)
+        idle_canvases.clear()
+        canvas_condition.notify_all()
+
+def get_canvas_bytes(mode, size):
+    """Memory used by a canvas of the given mode and size.
+
+    Pillow stores multi-band pixels in 4 bytes, so RGB costs as much as RGBA.
+    """
+    return size[0] * size[1] * (4 if Image.getmodebands(mode) > 1 else 1)
+
+def render_certificate(profile, row, font_size, font_name, canvas=None):
+    """Render the certificate for one data row and return it as an RGB image.
+
+    The certificate is drawn on canvas (already restored to the template) when given,
+    otherwise on a fresh copy of the template.
+    """
+    cert_image = canvas if canvas is not None else profile['template'].copy()
+
+    # Only add text for fields that are in the saved layout
+    for field_name, position, box in profile['text_fields']:
+        if field_name in row:
+            cert_image = add_text_to_image(
+                cert_image,
+                str(row[field_name]),
+                position,
+                font_size,
+                font_name,
+                fit_box=box
+            )
+
+    # Place all signatures at their positions
+    for signature_resized, signature_x, signature_y in profile['signature_placements']:
+        cert_image = paste_signature(cert_image, signature_resized, "custom", signature_x, signature_y)
+
+    return cert_image
+
+def encode_certificate(cert_image, cert_name):
+    """Encode a certificate as JPEG, falling back to PNG. Returns (filename, bytes)"""
+    buffer = BytesIO()
+    try:
+        cert_image.save(buffer, 'JPEG', quality=95)
+        return cert_name, buffer.getvalue()
+    except Exception as e:
+        print(f"Error saving certificate {cert_name}: {e}")
+        print(f"Image mode: {cert_image.mode}, Size: {cert_image.size}")
+        # Try to save as PNG if JPEG fails
+        try:
+            buffer = BytesIO()
+            cert_image.save(buffer, 'PNG')
+            png_name = cert_name.replace('.jpg', '.png')
+            print(f"Saved as PNG instead: {png_name}")
+            return png_name, buffer.getvalue()
+        except Exception as png_error:
+            print(f"Failed to save as PNG too: {png_error}")
+            raise e
+
+def get_render_key(profile, row, font_size, font_name):
+    """Hash all inputs that determine a certificate's pixels"""
+    key = hashlib.sha1(profile['fingerprint'].encode())
+    key.update(repr((font_name, font_size)).encode())
+    for field_name, position, box in profile['text_fields']:
+        if field_name in row:
+            key.update(repr((field_name, str(row[field_name]))).encode())
+    return key.hexdigest()
+
+def get_certificate_name(row, idx, extension='.jpg'):
+    """Build the certificate filename for a row"""
+    return f"certificate_{sanitize_filename(get_student_name(row))}_{idx + 1}{extension}"
+
+def render_row(profile, row, idx, font_size, font_name):
+    """Render one row on a pooled canvas. Returns (filename, bytes)"""
+    cert_name = get_certificate_name(row, idx)
+    canvas = acquire_canvas(profile['template'])
+    try:
+        cert_image = render_certificate(profile, row, font_size, font_name, canvas)
+        return encode_certificate(cert_image, cert_name)
+    finally:
+        release_canvas(canvas)
+
+def render_row_safely(profile, row, idx, font_size, font_name):
+    """Render one row, capturing a failure instead of aborting the whole batch.
+
+    Returns (idx, filename, payload, error); error is None when the row rendered.
+    """
+    try:
+        filename, payload = render_row(profile, row, idx, font_size, font_name)
+        return idx, filename, payload, None
+    except Exception as e:
+        print(f"Error rendering row {idx + 1}: {e}")
+        return idx, None, None, str(e)
+
+def render_batch(df, row_profiles, font_size, font_name):
+    """Render every row on the shared render workers, yielding results in row order.
+
+    Rows with identical render inputs are rendered only once and share the result.
+    Yields (idx, filename, payload, render_key, duplicate_of, error) where duplicate_of
+    is the index of the row that was actually rendered, or None for that row itself.
+    """
+    user_id = get_user_id()
+    rows = []
+    futures = {}
+    first_rows = {}
+    remaining = {}
+    for (idx, row), profile in zip(df.iterrows(), row_profiles):
+        render_key = get_render_key(profile, row, font_size, font_name)
+        rows.append((idx, row, render_key))
+        remaining[render_key] = remaining.get(render_key, 0) + 1
+        if render_key not in futures:
+            first_rows[render_key] = idx
+            futures[render_key] = submit_render(user_id, render_row_safely, profile, row, idx,
+                                                font_size, font_name)
+
+    for idx, row, render_key in rows:
+        _, filename, payload, error = futures[render_key].result()
+        # Let go of each result once its last row has been handed out
+        remaining[render_key] -= 1
+        if not remaining[render_key]:
+            del futures[render_key]
+
+        duplicate_of = first_rows[render_key]
+        if duplicate_of == idx:
+            duplicate_of = None
+        elif filename:
+            filename = get_certificate_name(row, idx, os.path.splitext(filename)[1])
+        yield idx, filename, payload, render_key, duplicate_of, error
+
+def describe_failure(df, idx, error):
+    """Build the report entry for a row that failed to render"""
+    try:
+        name = get_student_name(df.loc[idx])
+    except Exception:
+        name = "Unknown"
+    return {'row': int(idx) + 1, 'name': name, 'error': error}
+
+def describe_duplicate(idx, duplicate_of):
+    """Build the report entry for a row that reused another row's certificate"""
+    return {'row': int(idx) + 1, 'duplicate_of': int(duplicate_of) + 1}
+
+def write_file_or_link(path, data, source_path=None):
+    """Write data to path, hardlinking source_path instead when it has the same content"""
+    if source_path and os.path.exists(source_path):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            os.link(source_path, path)
+            return
+        except OSError as e:
+            print(f"Could not link {path}, writing a copy instead: {e}")
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def write_certificates(df, row_profiles, font_size, font_name, session_folder, certificate_files):
+    """Render rows into the session folder, filling certificate_files by row.
+
+    Rows that fail keep an empty entry so certificates stay aligned with their rows.
+    Rows identical to an earlier row are hardlinked to its file rather than stored again.
+    Returns (failures, duplicates).
+    """
+    failures = []
+    duplicates = []
+    for idx, filename, data, render_key, duplicate_of, error in render_batch(df, row_profiles, font_size, font_name):
+        if error is None:
+            try:
+                source_path = None
+                if duplicate_of is not None and certificate_files[duplicate_of]:
+                    source_path = os.path.join(session_folder, certificate_files[duplicate_of])
+                path = os.path.join(session_folder, filename)
+                write_file_or_link(path, data, source_path)
+                # Remember the render inputs so the certificate can be served with a strong ETag
+                write_file_or_link(path + '.etag', render_key.encode(), source_path and source_path + '.etag')
+                certificate_files[idx] = filename
+                if duplicate_of is not None:
+                    duplicates.append(describe_duplicate(idx, duplicate_of))
+                continue
+            except Exception as e:
+                print(f"Error writing certificate {filename}: {e}")
+                error = str(e)
+        certificate_files[idx] = ''
+        failures.append(describe_failure(df, idx, error))
+    return failures, duplicates
+
+def save_render_report(session_folder, certificate_files, failures, duplicates=None, profile_issues=None):
+    """Write the per-row render report for a batch and return it"""
+    report = {
+        'total': len(certificate_files),
+        'rendered': sum(1 for filename in certificate_files if filename),
+        'failed': failures,
+        'duplicates': duplicates or [],
+        'profiles': profile_issues or {'unmatched': [], 'failed': []}
+    }
+    try:
+        with open(os.path.join(session_folder, 'render_report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+    except Exception as e:
+        print(f"Error saving render report: {e}")
+    return report
+
+def load_render_report(session_folder):
+    """Load the render report of a batch, or None if there is none"""
+    report_path = os.path.join(session_folder, 'render_report.json')
+    if not os.path.exists(report_path):
+        return None
+    try:
+        with open(report_path, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error loading render report: {e}")
+        return None
+
+def write_pdf(pdf_file, pages):
+    """Write encoded certificate images into pdf_file as a PDF, one page per image.
+
+    JPEG data is embedded as it is, so pages are never decoded and only one page is held in
+    memory at a time; other formats are converted to JPEG first. Pages are sized like
+    Pillow's PDF writer does (one point per pixel).
+    """
+    # Objects 1 and 2 are the catalog and the page tree, written once all pages are known
+    offsets = [0, 0]
+    page_numbers = []
+
+    def write_object(data, number=None):
+        if number is None:
+            offsets.append(0)
+            number = len(offsets)
+        offsets[number - 1] = pdf_file.tell()
+        pdf_file.write(b'%d 0 obj\n' % number)
+        pdf_file.write(data)
+        pdf_file.write(b'\nendobj\n')
+        return number
+
+    def write_stream(header, data):
+        return write_object(b'<< %s /Length %d >>\nstream\n' % (header, len(data)) + data + b'\nendstream')
+
+    pdf_file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    for data in pages:
+        with Image.open(BytesIO(data)) as image:
+            width, height = image.size
+            if image.format != 'JPEG' or image.mode not in ('RGB', 'L'):
+                buffer = BytesIO()
+                image.convert('RGB').save(buffer, 'JPEG', quality=95)
+                data = buffer.getvalue()
+            color_space = b'DeviceGray' if image.format == 'JPEG' and image.mode == 'L' else b'DeviceRGB'
+
+        image_number = write_stream(
+            b'/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /%s '
+            b'/BitsPerComponent 8 /Filter /DCTDecode' % (width, height, color_space),
+            data
+        )
+        contents_number = write_stream(b'', b'q %d 0 0 %d 0 0 cm /image Do Q' % (width, height))
+        page_numbers.append(write_object(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R '
+            b'/Resources << /ProcSet [/PDF /ImageC] /XObject << /image %d 0 R >> >> >>'
+            % (width, height, contents_number, image_number)
+        ))
+
+    write_object(b'<< /Type /Catalog /Pages 2 0 R >>', 1)
+    kids = b' '.join(b'%d 0 R' % number for number in page_numbers)
+    write_object(b'<< /Type /Pages /Count %d /Kids [%s] >>' % (len(page_numbers), kids), 2)
+
+    xref_offset = pdf_file.tell()
+    pdf_file.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1))
+    for offset in offsets:
+        pdf_file.write(b'%010d 00000 n \n' % offset)
+    pdf_file.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                   % (len(offsets) + 1, xref_offset))
+
+def build_pdf(pages):
+    """Write encoded certificate images into a PDF in a temporary file, returned rewound"""
+    pdf_file = tempfile.TemporaryFile()
+    try:
+        write_pdf(pdf_file, pages)
+    except Exception:
+        pdf_file.close()
+        raise
+    pdf_file.seek(0)
+    return pdf_file
+
+def send_archive(archive_file, mimetype, download_name):
+    """Send a finished ZIP or PDF from its temporary file, which is closed once it has been sent"""
+    size = archive_file.seek(0, os.SEEK_END)
+    archive_file.seek(0)
+    response = send_file(archive_file, mimetype=mimetype, as_attachment=True, download_name=download_name)
+    response.content_length = size
+    return response
+
+def generate_direct_download(df, row_profiles, font_size, font_name, download_format, profile_issues=None):
+    """Render every certificate straight into a single ZIP or PDF, skipping the preview folder.
+
+    Each certificate is appended to a temporary archive file as soon as it is rendered, so
+    neither the certificates nor the archive are kept in memory. The archive is sent once
+    complete, so the response headers can report failures.
+    """
+    profile_issues = profile_issues or {'unmatched': [], 'failed': []}
+    failures = []
+    duplicates = []
+    if download_format == 'pdf':
+        page_count = 0
+
+        def rendered_pages():
+            nonlocal page_count
+            for idx, cert_name, data, render_key, duplicate_of, error in render_batch(
+                    df, row_profiles, font_size, font_name):
+                if error is None:
+                    # Duplicate rows add another page showing the same image
+                    page_count += 1
+                    if duplicate_of is not None:
+                        duplicates.append(describe_duplicate(idx, duplicate_of))
+                    yield data
+                else:
+                    failures.append(describe_failure(df, idx, error))
+
+        pdf_file = build_pdf(rendered_pages())
+        if not page_count:
+            pdf_file.close()
+            return 'No certificates found to include in PDF.', 400
+
+        response = send_archive(pdf_file, 'application/pdf', 'certificates.pdf')
+        response.headers['X-Certificates-Failed'] = str(len(failures))
+        response.headers['X-Profile-Fallback-Rows'] = str(count_profile_fallback_rows(profile_issues))
+        return response
+
+    zip_file = tempfile.TemporaryFile()
+    try:
+        write_direct_zip(zip_file, df, row_profiles, font_size, font_name, failures, duplicates, profile_issues)
+    except Exception:
+        zip_file.close()
+        raise
+
+    response = send_archive(zip_file, 'application/zip', 'certificates.zip')
+    response.headers['X-Certificates-Failed'] = str(len(failures))
+    response.headers['X-Profile-Fallback-Rows'] = str(count_profile_fallback_rows(profile_issues))
+    return response
+
+def write_direct_zip(zip_file, df, row_profiles, font_size, font_name, failures, duplicates, profile_issues):
+    """Render every certificate into zip_file, collecting failures and duplicates"""
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for idx, filename, data, render_key, duplicate_of, error in render_batch(df, row_profiles, font_size, font_name):
+            if error is not None:
+                failures.append(describe_failure(df, idx, error))
+                continue
+            if duplicate_of is not None:
+                # Identical rows reuse the encoded certificate instead of rendering it again
+                duplicates.append(describe_duplicate(idx, duplicate_of))
+            # JPEG data is already compressed, so store it instead of deflating it again
+            compress_type = zipfile.ZIP_STORED if filename.endswith('.jpg') else zipfile.ZIP_DEFLATED
+            zipf.writestr(filename, data, compress_type=compress_type)
+        if failures or duplicates or count_profile_fallback_rows(profile_issues):
+            # Ship the per-row report with the certificates that did render
+            report = {'total': len(df), 'rendered': len(df) - len(failures), 'failed': failures,
+                      'duplicates': duplicates, 'profiles': profile_issues}
+            zipf.writestr('render_report.json', json.dumps(report, indent=2))
+
+def get_generation_files():
+    """Get the template and data files for a generation request.
+
+    New uploads are used when present; otherwise the files kept from the previous batch are
+    reused. Returns (template_file, data_file, error) where error is None or
+    (message, status_code); callers decide how to report it.
+    """
+    # Check if we have existing form data and no new files uploaded
+    existing_form_data = None
+    if 'certificate_session' in session:
+        existing_form_data = session['certificate_session'].get('form_data')
+    
+    # Check if new files are uploaded
+    new_template = 'template' in request.files and request.files['template'].filename
+    new_data_file = 'data_file' in request.files and request.files['data_file'].filename
+    
+    if not new_template and not new_data_file and existing_form_data:
+        # Use existing files from previous session
+        session_id = session['certificate_session']['session_id']
+        session_folder = os.path.join(GENERATED_FOLDER, session_id)
+        
+        template_path = os.path.join(session_folder, existing_form_data['template_filename'])
+        data_path = os.path.join(session_folder, existing_form_data['data_filename'])
+        
+        if not os.path.exists(template_path) or not os.path.exists(data_path):
+            return None, None, ('Previous files not found. Please upload files again.', 410)
+        
+        # Create file objects from existing files
+        from werkzeug.datastructures import FileStorage
+        template_file = FileStorage(open(template_path, 'rb'), filename=existing_form_data['template_filename'])
+        data_file = FileStorage(open(data_path, 'rb'), filename=existing_form_data['data_filename'])
+    else:
+        # Use new uploaded files
+        if 'data_file' not in request.files or 'template' not in request.files:
+            return None, None, ("Missing data file or template", 400)
+        data_file = request.files['data_file']
+        template_file = request.files['template']
+
+    return template_file, data_file, None
+
+def get_signature_inputs():
+    """Read the uploaded signatures and their sizes. Returns (signature_images, signature_sizes)"""
+    signature_images = {}
+    signature_sizes = {}
+    
+    # Process all signature files (signature1, signature2, signature3, etc.)
+    for key, value in request.files.items():
+        if key.startswith('signature') and not key.endswith('_size'):
+            signature_images[key] = load_signature_image(value)
+    
+    # Process all signature sizes
+    for key, value in request.form.items():
+        if key.endswith('_size') and key.startswith('signature'):
+            signature_sizes[key.replace('_size', '')] = int(value)
+
+    return signature_images, signature_sizes
+
+def get_email_column(df):
+    """Find the data column holding recipient emails"""
+    for col in df.columns:
+        cl = str(col).lower()
+        if 'email' in cl or 'mail' in cl:
+            return col
+    return None
+
+def get_name_column(df):
+    """Find the data column holding student names"""
+    for col in df.columns:
+        if any(word in str(col).lower() for word in ['name', 'full_name', 'participant', 'student', 'attendee']):
+            return col
+    return None
+
+def check_text_fits(font, font_key, text, position, template_size, max_text_width, line_spacing=1.2, box=None):
+    """Check whether text drawn by add_text_to_image stays on the template (and in its box).
+
+    Returns a description of the problem, or None if the text fits.
+    """
+    lines, total_text_height = layout_text(font, font_key, text, max_text_width, line_spacing)
+    if not lines:
+        return None
+    template_width, template_height = template_size
+    widest = max(width for _, width, _ in lines)
+    if widest > max_text_width:
+        return 'wider than the text area even after wrapping'
+    if box and total_text_height > box[1]:
+        return 'taller than its box even at the smallest font size'
+    left = position[0] - widest // 2
+    if left < 0 or left + widest > template_width:
+        return 'runs past the side of the template'
+    top = position[1] - total_text_height // 2
+    if top < 0 or top + total_text_height > template_height:
+        return 'runs past the top or bottom of the template'
+    return None
+
+def analyze_batch(df, row_profiles, font_name, font_size, saved_layout, profile_issues=None):
+    """Check a batch for problems before rendering it, without drawing any certificate.
+
+    Every field value is measured once per distinct value and mapped back onto the rows,
+    so checking a large roster costs little more than checking its distinct values.
+    """
+    report = {'rows': len(df), 'errors': [], 'warnings': []}
+
+    # Fonts: add_text_to_image silently falls back to the default font
+    font_found = os.path.exists(get_font_path(font_name))
+    report['font'] = {'name': font_name, 'found': font_found}
+    if not font_found:
+        report['errors'].append(f"Font file {font_name} not found, the default font would be used.")
+
+    # Rows whose profile is unknown or broken silently get the uploaded template
+    report['profiles'] = profile_issues or {'unmatched': [], 'failed': []}
+    report['errors'].extend(describe_profile_issues(profile_issues))
+
+    # Layout fields without a matching column are never drawn
+    layout_fields = [field for field in saved_layout if not field.startswith('signature')]
+    missing_fields = [field for field in layout_fields if field not in df.columns]
+    report['missing_layout_fields'] = missing_fields
+    if missing_fields:
+        report['warnings'].append(f"Layout fields with no matching column: {', '.join(missing_fields)}")
+    if not layout_fields:
+        report['warnings'].append('The saved layout has no text fields.')
+
+    # Emails
+    email_col = get_email_column(df)
+    report['email'] = {'column': email_col, 'missing_rows': [], 'invalid_rows': []}
+    if email_col is None:
+        report['warnings'].append('No email column found, certificates cannot be emailed.')
+    else:
+        emails = df[email_col].astype(str).str.strip()
+        missing = df[email_col].isna() | emails.eq('') | emails.str.lower().isin(['nan', 'none'])
+        invalid = ~missing & ~emails.str.contains('@', regex=False)
+        report['email']['missing_rows'] = [int(idx) + 1 for idx in df.index[missing]]
+        report['email']['invalid_rows'] = [int(idx) + 1 for idx in df.index[invalid]]
+        if missing.any():
+            report['warnings'].append(f"{int(missing.sum())} rows have no email address.")
+        if invalid.any():
+            report['warnings'].append(f"{int(invalid.sum())} rows have an invalid email address.")
+
+    # Names that sanitize to the same filename are only told apart by their row number
+    name_col = get_name_column(df)
+    duplicates = []
+    if name_col is not None:
+        sanitized = df[name_col].astype(str).map(sanitize_filename)
+        repeated = sanitized[sanitized.duplicated(keep=False)]
+        for filename, rows in repeated.groupby(repeated, sort=False):
+            duplicates.append({'name': filename, 'rows': [int(idx) + 1 for idx in rows.index]})
+    report['duplicate_names'] = duplicates
+    if duplicates:
+        report['warnings'].append(f"{len(duplicates)} names appear on more than one row.")
+
+    # Text overflow, measured per profile, field and distinct value
+    font = load_font(font_name, font_size)
+    font_key = (font_name, font_size)
+    profile_rows = {}
+    for idx, profile in zip(df.index, row_profiles):
+        profile_rows.setdefault(id(profile), (profile, []))[1].append(idx)
+
+    overflow = []
+    autofit = []
+    estimated_seconds = 0.0
+    estimated_bytes = 0
+    for profile, rows in profile_rows.values():
+        template_size = profile['template'].size
+        max_text_width = int(template_size[0] * 0.8)  # add_text_to_image's max_width_ratio
+        for field_name, position, box in profile['text_fields']:
+            if field_name not in df.columns:
+                continue
+            values = df.loc[rows, field_name].astype(str)
+            problems = {}
+            fitted_sizes = []
+            for value in values.unique():
+                if box:
+                    # Check auto-fit values at the size they will be drawn at
+                    fitted_size = fit_font_size(font_name, font_size, value, box)
+                    fitted_sizes.append(fitted_size)
+                    problem = check_text_fits(load_font(font_name, fitted_size), (font_name, fitted_size),
+                                              value, position, template_size, box[0], box=box)
+                else:
+                    problem = check_text_fits(font, font_key, value, position, template_size, max_text_width)
+                if problem:
+                    problems[value] = problem
+            if fitted_sizes:
+                autofit.append({'field': field_name, 'box': list(box),
+                                'min_font_size': min(fitted_sizes), 'max_font_size': max(fitted_sizes)})
+            if problems:
+                for idx, value in values[values.isin(list(problems))].items():
+                    overflow.append({'row': int(idx) + 1, 'field': field_name, 'value': value,
+                                     'problem': problems[value]})
+
+        # Time copying and encoding the bare template as a per-row cost estimate
+        started = time.perf_counter()
+        sample = profile['template'].copy()
+        buffer = BytesIO()
+        sample.save(buffer, 'JPEG', quality=95)
+        estimated_seconds += (time.perf_counter() - started) * len(rows)
+        estimated_bytes += buffer.tell() * len(rows)
+
+    overflow.sort(key=lambda item: item['row'])
+    report['overflow'] = overflow
+    report['autofit'] = autofit
+    if overflow:
+        report['errors'].append(f"{len(overflow)} field values do not fit on the certificate.")
+
+    report['estimate'] = {
+        'render_seconds': round(estimated_seconds / RENDER_WORKERS, 2),
+        'output_bytes': estimated_bytes
+    }
+    report['ok'] = not report['errors']
+    return report
+
+for _ in range(RENDER_WORKERS):
+    threading.Thread(target=render_worker, daemon=True).start()
+
 @app.route('/')
 def home():
     return render_template('home.html')
@@ -352,62 +1652,23 @@ def clear_session():
 
 @app.route('/generate', methods=['POST'])
 def generate_certificates():
-    # Check if we have existing form data and no new files uploaded
-    existing_form_data = None
-    if 'certificate_session' in session:
-        existing_form_data = session['certificate_session'].get('form_data')
-    
-    # Check if new files are uploaded
-    new_template = 'template' in request.files and request.files['template'].filename
-    new_data_file = 'data_file' in request.files and request.files['data_file'].filename
-    
-    if not new_template and not new_data_file and existing_form_data:
-        # Use existing files from previous session
-        session_id = session['certificate_session']['session_id']
-        session_folder = os.path.join(GENERATED_FOLDER, session_id)
-        
-        template_path = os.path.join(session_folder, existing_form_data['template_filename'])
-        data_path = os.path.join(session_folder, existing_form_data['data_filename'])
-        
-        if not os.path.exists(template_path) or not os.path.exists(data_path):
-            flash('Previous files not found. Please upload files again.', 'error')
+    template_file, data_file, error = get_generation_files()
+    if error:
+        message, status_code = error
+        if status_code == 410:
+            # The previous batch's files are gone, so start again from the upload form
+            flash(message, 'error')
             return redirect(url_for('index'))
-        
-        # Create file objects from existing files
-        from werkzeug.datastructures import FileStorage
-        template_file = FileStorage(open(template_path, 'rb'), filename=existing_form_data['template_filename'])
-        data_file = FileStorage(open(data_path, 'rb'), filename=existing_form_data['data_filename'])
-    else:
-        # Use new uploaded files
-        if 'data_file' not in request.files or 'template' not in request.files:
-            return "Missing data file or template", 400
-        data_file = request.files['data_file']
-        template_file = request.files['template']
+        return message, status_code
 
     font_name = request.form.get('font', 'DancingScript-Regular.ttf')
     font_size = int(request.form.get('fontsize', 36))
     
     # Get multiple signature configuration
-    signature_images = {}
-    signature_sizes = {}
+    signature_images, signature_sizes = get_signature_inputs()
     
-    # Process all signature files (signature1, signature2, signature3, etc.)
-    for key, value in request.files.items():
-        if key.startswith('signature') and not key.endswith('_size'):
-            try:
-                signature_image = Image.open(value)
-                # Convert to RGBA to handle transparency
-                if signature_image.mode != 'RGBA':
-                    signature_image = signature_image.convert('RGBA')
-                signature_images[key] = signature_image
-            except Exception as e:
-                print(f"Error loading signature {key}: {e}")
-                signature_images[key] = None
-    
-    # Process all signature sizes
-    for key, value in request.form.items():
-        if key.endswith('_size') and key.startswith('signature'):
-            signature_sizes[key.replace('_size', '')] = int(value)
+    user_id = get_user_id()
+    admitted = False
     
     # Get layout configuration
     layout_config = {}
@@ -423,38 +1684,32 @@ def generate_certificates():
     try:
         # Read the data file
         file_extension = os.path.splitext(data_file.filename)[1].lower()
-        if file_extension == '.csv':
-            df = pd.read_csv(data_file)
-        elif file_extension in ['.xlsx', '.xls']:
-            df = pd.read_excel(data_file)
-        else:
+        if file_extension not in ['.csv', '.xlsx', '.xls']:
             return "Unsupported file format. Please upload a CSV or Excel file.", 400
+        df = read_data_file(data_file, file_extension)
+
+        # Wait for room on the render workers instead of starving other users
+        retry_after = admit_batch(user_id, len(df))
+        if retry_after is not None:
+            return (f"The server is busy generating other certificates. Please try again in {retry_after} seconds.",
+                    429, {'Retry-After': str(retry_after)})
+        admitted = True
 
         # Load the template image
-        template = Image.open(template_file)
-        
-        # Convert template to RGB mode to avoid RGBA issues when saving as JPEG
-        if template.mode == 'RGBA':
-            # Create a white background
-            background = Image.new('RGB', template.size, (255, 255, 255))
-            background.paste(template, mask=template.split()[-1])  # Use alpha channel as mask
-            template = background
-        elif template.mode != 'RGB':
-            template = template.convert('RGB')
-        
-        template_width, template_height = template.size
+        template = load_template_image(template_file)
 
         # Load saved layout configuration
-        saved_layout = {}
-        # On Vercel, use /tmp for writable files; otherwise use static/uploads
-        layout_file_path = '/tmp/layout.json' if IS_VERCEL else 'static/uploads/layout.json'
-        if os.path.exists(layout_file_path):
-            try:
-                with open(layout_file_path, 'r') as f:
-                    saved_layout = json.load(f)
-            except Exception as e:
-                print(f"Error loading layout file: {e}")
-                saved_layout = {}
+        saved_layout = load_saved_layout()
+
+        # Prepare the uploaded template once, plus any named profiles selected by the rows
+        profile_configs = load_profiles()
+        default_profile = prepare_profile(template, signature_images, signature_sizes, saved_layout)
+        row_profiles, profile_issues = get_row_profiles(df, default_profile, saved_layout, profile_configs)
+
+        # Direct download: render straight into the archive, skipping the preview folder
+        output_mode = request.form.get('output_mode', 'preview').lower()
+        if output_mode in ['zip', 'pdf']:
+            return generate_direct_download(df, row_profiles, font_size, font_name, output_mode, profile_issues)
 
         # Generate unique session ID for this batch
         session_id = str(uuid.uuid4())
@@ -468,109 +1723,31 @@ def generate_certificates():
         template_path = os.path.join(session_folder, template_filename)
         data_path = os.path.join(session_folder, data_filename)
         
+        # The uploads were already read above, so rewind them before saving
+        template_file.stream.seek(0)
         template_file.save(template_path)
+        data_file.stream.seek(0)
         data_file.save(data_path)
 
-        # Create certificates
-        certificate_files = []
-        for idx, row in df.iterrows():
-            # Extract student name for filename
-            student_name = "Unknown"
-            for field_name in row.index:
-                if any(word in field_name.lower() for word in ['name', 'full_name', 'participant', 'student', 'attendee']):
-                    student_name = str(row[field_name])
-                    break
-            
-            # Create filename with student name
-            sanitized_name = sanitize_filename(student_name)
-            cert_name = f"certificate_{sanitized_name}_{idx + 1}.jpg"
-            cert_path = os.path.join(session_folder, cert_name)
-            cert_image = template.copy()
-            
-            # Only add text for fields that are in the saved layout
-            for field_name, position in saved_layout.items():
-                if field_name in row:
-                    text_value = str(row[field_name])
-                    # Convert canvas coordinates to image coordinates
-                    x = int(position[0] * template_width / 1000)  # canvas width is 1000
-                    y = int(position[1] * template_height / 700)  # canvas height is 700
-                    
-                    cert_image = add_text_to_image(
-                        cert_image, 
-                        text_value, 
-                        (x, y), 
-                        font_size, 
-                        font_name
-                    )
-            
-            # Add all signatures if provided and positioned
-            for sig_key, sig_image in signature_images.items():
-                if not sig_image:
-                    continue
-                
-                # Handle new signature placement logic
-                # Look for all positions where this signature should be placed
-                signature_positions = []
-                
-                # Check for new naming convention (signature1_pos1, signature1_pos2, etc.)
-                sig_number = sig_key.replace('signature', '')
-                for layout_key, position in saved_layout.items():
-                    if layout_key.startswith(f'signature{sig_number}_pos'):
-                        signature_positions.append((layout_key, position))
-                
-                # Legacy support: check for old naming convention
-                if not signature_positions:
-                    if sig_key in saved_layout:
-                        signature_positions.append((sig_key, saved_layout[sig_key]))
-                    elif sig_key == 'signature1' and 'signature' in saved_layout:
-                        signature_positions.append(('signature', saved_layout['signature']))
-                
-                # Place signature at all found positions
-                for layout_key, position in signature_positions:
-                    # Convert canvas coordinates to image coordinates
-                    signature_x = int(position[0] * template_width / 1000)  # canvas width is 1000
-                    signature_y = int(position[1] * template_height / 700)  # canvas height is 700
-
-                    # Get size for this signature
-                    sig_size = signature_sizes.get(sig_key, 20)
-
-                    cert_image = add_signature_to_image(
-                        cert_image,
-                        sig_image,
-                        "custom",
-                        signature_x,
-                        signature_y,
-                        sig_size
-                    )
-            
-            # Ensure image is in RGB mode before saving as JPEG
-            if cert_image.mode == 'RGBA':
-                # Create a white background
-                background = Image.new('RGB', cert_image.size, (255, 255, 255))
-                background.paste(cert_image, mask=cert_image.split()[-1])  # Use alpha channel as mask
-                cert_image = background
-            elif cert_image.mode not in ['RGB', 'L']:
-                # Convert other modes to RGB
-                cert_image = cert_image.convert('RGB')
-            elif cert_image.mode == 'L':
-                # Convert grayscale to RGB
-                cert_image = cert_image.convert('RGB')
-            
-            try:
-                cert_image.save(cert_path, 'JPEG', quality=95)
-                certificate_files.append(cert_name)
-            except Exception as e:
-                print(f"Error saving certificate {cert_name}: {e}")
-                print(f"Image mode: {cert_image.mode}, Size: {cert_image.size}")
-                # Try to save as PNG if JPEG fails
-                try:
-                    png_path = cert_path.replace('.jpg', '.png')
-                    cert_image.save(png_path, 'PNG')
-                    certificate_files.append(os.path.basename(png_path))
-                    print(f"Saved as PNG instead: {png_path}")
-                except Exception as png_error:
-                    print(f"Failed to save as PNG too: {png_error}")
-                    raise e
+        # Keep signatures so failed rows can be rendered again later
+        signature_files = {}
+        for sig_key, sig_image in signature_images.items():
+            if sig_image:
+                signature_files[sig_key] = f"{sig_key}_{session_id}.png"
+                sig_image.save(os.path.join(session_folder, signature_files[sig_key]), 'PNG')
+
+        # Keep the layout and profiles too, since they may be edited before a retry
+        layout_filename = f"layout_{session_id}.json"
+        with open(os.path.join(session_folder, layout_filename), 'w') as f:
+            json.dump(saved_layout, f)
+        profiles_filename = snapshot_profiles(df, profile_configs, session_folder, session_id)
+
+        # Create certificates, isolating failures per row
+        certificate_files = [''] * len(df)
+        failures, duplicates = write_certificates(df, row_profiles, font_size, font_name, session_folder, certificate_files)
+        save_render_report(session_folder, certificate_files, failures, duplicates, profile_issues)
+        for message in describe_profile_issues(profile_issues):
+            flash(message, 'error')
 
         # Extract student names for display
         student_names = []
@@ -595,6 +1772,7 @@ def generate_certificates():
             'certificate_files': certificate_files,
             'student_names': student_names,
             'recipient_emails': recipient_emails,
+            'failed_rows': [failure['row'] - 1 for failure in failures],
             'form_data': {
                 'font_name': font_name,
                 'font_size': font_size,
@@ -602,7 +1780,10 @@ def generate_certificates():
                 'template_filename': template_filename,
                 'data_filename': data_filename,
                 'file_extension': file_extension,
-                'signature_sizes': signature_sizes
+                'signature_sizes': signature_sizes,
+                'signature_files': signature_files,
+                'layout_filename': layout_filename,
+                'profiles_filename': profiles_filename
             }
         }
         
@@ -612,6 +1793,38 @@ def generate_certificates():
 
     except Exception as e:
         return f"Error generating certificates: {str(e)}", 500
+    finally:
+        if admitted:
+            finish_batch(user_id)
+
+@app.route('/preflight', methods=['POST'])
+def preflight_check():
+    """Dry run: check a batch for problems and estimate its cost without rendering it"""
+    template_file, data_file, error = get_generation_files()
+    if error:
+        message, status_code = error
+        return jsonify({"status": "error", "message": message}), status_code
+
+    font_name = request.form.get('font', 'DancingScript-Regular.ttf')
+    font_size = int(request.form.get('fontsize', 36))
+    signature_images, signature_sizes = get_signature_inputs()
+
+    try:
+        file_extension = os.path.splitext(data_file.filename)[1].lower()
+        if file_extension not in ['.csv', '.xlsx', '.xls']:
+            return jsonify({"status": "error", "message": "Unsupported file format. Please upload a CSV or Excel file."}), 400
+        df = read_data_file(data_file, file_extension)
+
+        template = load_template_image(template_file)
+        saved_layout = load_saved_layout()
+        default_profile = prepare_profile(template, signature_images, signature_sizes, saved_layout)
+        row_profiles, profile_issues = get_row_profiles(df, default_profile, saved_layout)
+
+        report = analyze_batch(df, row_profiles, font_name, font_size, saved_layout, profile_issues)
+        report['status'] = 'success'
+        return jsonify(report)
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/preview')
 def preview_certificates():
@@ -623,11 +1836,95 @@ def preview_certificates():
     session_id = session_data['session_id']
     certificate_files = session_data['certificate_files']
     
+    failures = []
+    if session_data.get('failed_rows'):
+        report = load_render_report(os.path.join(GENERATED_FOLDER, session_id))
+        failures = report['failed'] if report else []
+    
     return render_template('preview.html', 
                          session_id=session_id, 
                          certificate_files=certificate_files,
                          student_names=session_data.get('student_names', []),
-                         total_certificates=session_data['total_certificates'])
+                         total_certificates=session_data['total_certificates'],
+                         failures=failures)
+
+@app.route('/render_report')
+def render_report():
+    """Return the per-row render report of the current batch"""
+    if 'certificate_session' not in session:
+        return jsonify({"status": "error", "message": "No certificates generated."}), 404
+    
+    session_id = session['certificate_session']['session_id']
+    report = load_render_report(os.path.join(GENERATED_FOLDER, session_id))
+    if report is None:
+        return jsonify({"status": "error", "message": "Render report not found."}), 404
+    return jsonify(report)
+
+@app.route('/retry_failed', methods=['POST'])
+def retry_failed_rows():
+    """Render only the rows that failed in the current batch"""
+    if 'certificate_session' not in session:
+        flash('No certificates to retry. Please generate certificates first.', 'error')
+        return redirect(url_for('index'))
+    
+    session_data = session['certificate_session']
+    failed_rows = session_data.get('failed_rows', [])
+    if not failed_rows:
+        return redirect(url_for('preview_certificates'))
+    
+    session_id = session_data['session_id']
+    session_folder = os.path.join(GENERATED_FOLDER, session_id)
+    form_data = session_data['form_data']
+    
+    user_id = get_user_id()
+    retry_after = admit_batch(user_id, len(failed_rows))
+    if retry_after is not None:
+        return (f"The server is busy generating other certificates. Please try again in {retry_after} seconds.",
+                429, {'Retry-After': str(retry_after)})
+    
+    try:
+        df = read_data_file(os.path.join(session_folder, form_data['data_filename']), form_data['file_extension'])
+        template = load_template_image(os.path.join(session_folder, form_data['template_filename']))
+        signature_images = {}
+        for sig_key, signature_filename in form_data.get('signature_files', {}).items():
+            signature_images[sig_key] = load_signature_image(os.path.join(session_folder, signature_filename))
+        
+        # Render with the layout the rest of the batch used
+        layout_path = os.path.join(session_folder, form_data.get('layout_filename', ''))
+        if form_data.get('layout_filename') and os.path.exists(layout_path):
+            with open(layout_path, 'r') as f:
+                saved_layout = json.load(f)
+        else:
+            saved_layout = load_saved_layout()
+        # ...and the profiles it used
+        profile_configs = None
+        profiles_path = os.path.join(session_folder, form_data.get('profiles_filename', ''))
+        if form_data.get('profiles_filename') and os.path.exists(profiles_path):
+            with open(profiles_path, 'r') as f:
+                profile_configs = json.load(f)
+        default_profile = prepare_profile(template, signature_images, form_data['signature_sizes'], saved_layout)
+        failed_df = df.loc[[idx for idx in failed_rows if idx in df.index]]
+        row_profiles, _ = get_row_profiles(failed_df, default_profile, saved_layout, profile_configs)
+        
+        certificate_files = list(session_data['certificate_files'])
+        failures, duplicates = write_certificates(failed_df, row_profiles, form_data['font_size'], form_data['font_name'],
+                                                  session_folder, certificate_files)
+        previous_report = load_render_report(session_folder) or {}
+        save_render_report(session_folder, certificate_files, failures,
+                           previous_report.get('duplicates', []) + duplicates, previous_report.get('profiles'))
+    except Exception as e:
+        flash(f'Error rendering failed certificates: {e}', 'error')
+        return redirect(url_for('preview_certificates'))
+    finally:
+        finish_batch(user_id)
+    
+    session_data['certificate_files'] = certificate_files
+    session_data['failed_rows'] = [failure['row'] - 1 for failure in failures]
+    session['certificate_session'] = session_data
+    
+    if failures:
+        flash(f'{len(failed_rows) - len(failures)} certificates rendered, {len(failures)} still failing.', 'error')
+    return redirect(url_for('preview_certificates'))
 
 @app.route('/download')
 def download_certificates():
@@ -657,41 +1954,21 @@ def download_certificates():
             if not image_filenames:
                 return 'No certificates found to include in PDF.', 400
 
-            # Open images and convert to RGB
-            images = []
-            for fn in image_filenames:
-                img = Image.open(os.path.join(session_folder, fn))
-                if img.mode in ['RGBA', 'P']:
-                    img = img.convert('RGB')
-                elif img.mode != 'RGB':
-                    img = img.convert('RGB')
-                images.append(img)
+            def read_pages():
+                # Read one certificate at a time while the PDF is written
+                for fn in image_filenames:
+                    with open(os.path.join(session_folder, fn), 'rb') as f:
+                        yield f.read()
 
             # Save all into a single PDF
-            pdf_buffer = BytesIO()
-            try:
-                first_image, *rest_images = images
-                first_image.save(pdf_buffer, format='PDF', save_all=True, append_images=rest_images)
-            finally:
-                # Close images to free resources
-                for im in images:
-                    try:
-                        im.close()
-                    except Exception:
-                        pass
-            pdf_buffer.seek(0)
+            pdf_file = build_pdf(read_pages())
 
             # Cleanup after preparing download
             import shutil
             shutil.rmtree(session_folder)
             session.pop('certificate_session', None)
 
-            return send_file(
-                pdf_buffer,
-                mimetype='application/pdf',
-                as_attachment=True,
-                download_name='certificates.pdf'
-            )
+            return send_archive(pdf_file, 'application/pdf', 'certificates.pdf')
         else:
             # Default: ZIP
             zip_buffer = BytesIO()
@@ -718,26 +1995,70 @@ def download_certificates():
 
 @app.route('/static/generated/<session_id>/<filename>')
 def serve_certificate(session_id, filename):
-    """Serve individual certificate images for preview"""
-    file_path = os.path.join(GENERATED_FOLDER, session_id, filename)
-    if os.path.exists(file_path):
-        return send_file(file_path)
-    else:
+    """Serve individual certificate images for preview.
+
+    Certificates get a strong ETag from their render inputs, so repeated preview loads are
+    answered with 304 Not Modified; range requests and pre-compressed sidecars are supported.
+    """
+    file_path = safe_join(GENERATED_FOLDER, session_id, filename)
+    if file_path is None or not os.path.isfile(file_path):
         return "Certificate not found", 404
 
+    etag = True
+    etag_path = file_path + '.etag'
+    if os.path.exists(etag_path):
+        try:
+            with open(etag_path, 'r') as f:
+                etag = f.read().strip() or True
+        except Exception as e:
+            print(f"Error reading ETag for {filename}: {e}")
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    # Serve a pre-compressed sidecar (certificate.png.br / .gz) if the client accepts it
+    content_encoding = None
+    accepted = request.accept_encodings
+    for encoding, extension in [('br', '.br'), ('gzip', '.gz')]:
+        if accepted[encoding] and os.path.isfile(file_path + extension):
+            file_path += extension
+            content_encoding = encoding
+            if isinstance(etag, str):
+                etag = f"{etag}-{encoding}"
+            break
+
+    response = send_file(
+        file_path,
+        mimetype=mimetype,
+        conditional=True,
+        etag=etag,
+        max_age=CERTIFICATE_MAX_AGE
+    )
+    # Certificates belong to one user's batch, so only the browser may cache them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.vary.add('Accept-Encoding')
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    return response
+
+@app.route('/layout')
+def get_layout():
+    """Return the layout the next batch will use, for the position editor to restore"""
+    shared = get_saved_layout_file_path() != get_layout_file_path(get_user_id())
+    # Keep the saved field order, which the editor's undo history follows
+    response = app.response_class(json.dumps({"layout": load_saved_layout(), "shared": shared}),
+                                  mimetype='application/json')
+    # The layout changes whenever it is saved
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/save_layout', methods=['POST'])
 def save_layout():
     """Save layout configuration from the position editor"""
     try:
         layout_data = request.get_json()
-        # Save layout to a JSON file
-        # On Vercel, use /tmp for writable files; otherwise use static/uploads
-        layout_file_path = '/tmp/layout.json' if IS_VERCEL else 'static/uploads/layout.json'
-        # Ensure directory exists if not using /tmp
-        if not IS_VERCEL:
-            os.makedirs(os.path.dirname(layout_file_path), exist_ok=True)
-        with open(layout_file_path, 'w') as f:
-            json.dump(layout_data, f, indent=2)
+        # Save layout to this user's JSON file
+        write_json_atomically(get_layout_file_path(get_user_id()), layout_data)
         return jsonify({"status": "success", "message": "Layout saved successfully!"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -784,11 +2105,7 @@ def send_emails():
             return redirect(url_for('preview_certificates'))
 
         # Heuristically detect email column
-        for col in df.columns:
-            cl = str(col).lower()
-            if 'email' in cl or 'mail' in cl:
-                email_col = col
-                break
+        email_col = get_email_column(df)
         if email_col is None:
             flash('No email column found in your data. Include a column with "email" in its name.', 'error')
             return redirect(url_for('preview_certificates'))
@@ -822,6 +2139,10 @@ def send_emails():
                 failures.append((idx + 1, 'Missing email'))
                 continue
 
+            if not cert_filename:
+                failures.append((idx + 1, 'Certificate not rendered'))
+                continue
+
             cert_path = os.path.join(session_folder, cert_filename)
             if not os.path.exists(cert_path):
                 failures.append((idx + 1, 'Certificate file missing'))
@@ -0,0 +1,432 @@
+"""
+Load test for the certificate generator.
+
+Drives the Flask app in-process with its test client: several simulated users generate,
+preview, download and email certificates for synthetic rosters at the same time, while a
+local SMTP sink stands in for the mail server. For each scenario it reports throughput,
+latency percentiles per endpoint, peak RSS and the disk usage of GENERATED_FOLDER.
+
+Usage:
+    python load_test.py [--users 4] [--rows 50] [--rounds 2] [--size 1000x700]
+                        [--scenario all|preview|download_zip|download_pdf|direct_zip|direct_pdf|send_emails]
+                        [--json results.json]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socketserver
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+# The app resolves fonts and layouts relative to the project folder
+PROJECT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+os.chdir(PROJECT_FOLDER)
+sys.path.insert(0, PROJECT_FOLDER)
+
+import app as certificate_app
+
+FIRST_NAMES = ['Akhila', 'Ramana', 'Lakshmi', 'Sri', 'Kiran', 'Venkata', 'Sai', 'Radhika', 'Soujanya', 'Mahender']
+LAST_NAMES = ['Koyada', 'Babu', 'Naik', 'Reddy', 'Rao', 'Kumar', 'Sharma', 'Varma']
+BRANCHES = ['ECE', 'EEE', 'Mech', 'CSE', 'Civil']
+ACTIVITIES = ['NSS Volunteer', 'Technical Symposium', 'Sports Meet', 'Coding Contest', 'Blood Donation Camp']
+
+SCENARIOS = ['preview', 'download_zip', 'download_pdf', 'direct_zip', 'direct_pdf', 'send_emails']
+
+
+def make_roster(rows, seed):
+    """Build a synthetic CSV roster matching the fields of the saved layout"""
+    rng = random.Random(seed)
+    lines = ['name,branch,activities,rno,email']
+    for i in range(rows):
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+        lines.append(f"{name},{rng.choice(BRANCHES)},{rng.choice(ACTIVITIES)},R{seed:03d}{i:04d},"
+                     f"student{seed}_{i}@example.org")
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def make_template(size):
+    """Build a synthetic certificate template as JPEG bytes"""
+    template = Image.new('RGB', size, (250, 246, 232))
+    draw = ImageDraw.Draw(template)
+    border = max(size) // 60
+    draw.rectangle([border, border, size[0] - border, size[1] - border], outline=(150, 110, 40), width=border // 2)
+    for y in range(0, size[1], 8):
+        draw.line([(0, y), (size[0], y)], fill=(245, 240, 225))
+    buffer = BytesIO()
+    template.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Accepts mail like a real server (STARTTLS, AUTH PLAIN) and discards it"""
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        tls = False
+        self.reply('220 localhost load-test SMTP sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode(errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                extensions = ['localhost', 'AUTH PLAIN', 'SIZE 52428800']
+                if not tls:
+                    extensions.insert(1, 'STARTTLS')
+                for extension in extensions[:-1]:
+                    self.reply(f'250-{extension}')
+                self.reply(f'250 {extensions[-1]}')
+            elif verb == 'STARTTLS':
+                self.reply('220 Ready to start TLS')
+                self.connection = self.server.ssl_context.wrap_socket(self.connection, server_side=True)
+                self.rfile = self.connection.makefile('rb')
+                self.wfile = self.connection.makefile('wb', buffering=0)
+                tls = True
+            elif verb == 'AUTH':
+                self.reply('235 Authentication successful')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b'.\r\n':
+                        break
+                    size += len(data_line)
+                self.server.record_message(size)
+                self.reply('250 OK: message accepted')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Local SMTP server that counts the messages it receives"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, ssl_context):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.ssl_context = ssl_context
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+
+    def record_message(self, size):
+        with self.lock:
+            self.messages += 1
+            self.bytes += size
+
+
+def start_smtp_sink(work_folder):
+    """Start the SMTP sink with a throwaway self-signed certificate, or return None"""
+    cert_path = os.path.join(work_folder, 'sink.pem')
+    try:
+        subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+             '-subj', '/CN=localhost', '-keyout', cert_path, '-out', cert_path],
+            check=True, capture_output=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Could not create a certificate for the SMTP sink (openssl is required for STARTTLS): {e}")
+        return None
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert_path)
+    sink = SMTPSink(ssl_context)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    return sink
+
+
+def get_rss_bytes():
+    """Current resident memory of this process"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # ru_maxrss is the peak so far, in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def get_folder_bytes(folder):
+    """Disk space used by a folder, counting hardlinked files once"""
+    total = 0
+    seen = set()
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            try:
+                stat = os.stat(os.path.join(root, filename))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+class ResourceSampler(threading.Thread):
+    """Samples RSS and GENERATED_FOLDER size in the background to find their peaks"""
+
+    def __init__(self, folder, interval=0.05):
+        super().__init__(daemon=True)
+        self.folder = folder
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak_rss = get_rss_bytes()
+        self.peak_disk = get_folder_bytes(folder)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, get_rss_bytes())
+            self.peak_disk = max(self.peak_disk, get_folder_bytes(self.folder))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Metrics:
+    """Collects request latencies per endpoint across simulated users"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.throttled = 0
+        self.certificates = 0
+        self.errors = []
+
+    def record(self, label, seconds, status):
+        with self.lock:
+            self.latencies.setdefault(label, []).append(seconds)
+            self.statuses.setdefault(label, {}).setdefault(status, 0)
+            self.statuses[label][status] += 1
+
+    def add_certificates(self, count):
+        with self.lock:
+            self.certificates += count
+
+    def add_error(self, message):
+        with self.lock:
+            self.errors.append(message)
+
+
+def timed_request(metrics, label, send, max_wait=120):
+    """Send a request, honouring 429 Retry-After hints, and record its latency"""
+    waited = 0
+    while True:
+        started = time.perf_counter()
+        response = send()
+        elapsed = time.perf_counter() - started
+        if response.status_code != 429 or waited >= max_wait:
+            metrics.record(label, elapsed, response.status_code)
+            return response
+        with metrics.lock:
+            metrics.throttled += 1
+        retry_after = int(response.headers.get('Retry-After', 1))
+        time.sleep(retry_after)
+        waited += retry_after
+
+
+def post_generate(client, metrics, roster, template, output_mode='preview'):
+    """Submit a batch to /generate"""
+    return timed_request(metrics, f'POST /generate ({output_mode})', lambda: client.post(
+        '/generate',
+        data={
+            'template': (BytesIO(template), 'template.jpg'),
+            'data_file': (BytesIO(roster), 'roster.csv'),
+            'font': 'GreatVibes-Regular.ttf',
+            'fontsize': '40',
+            'output_mode': output_mode,
+        },
+        content_type='multipart/form-data'
+    ))
+
+
+def get_certificate_files(client):
+    with client.session_transaction() as user_session:
+        batch = user_session.get('certificate_session', {})
+    return batch.get('session_id'), [f for f in batch.get('certificate_files', []) if f]
+
+
+def run_user(scenario, client, metrics, roster, template, rows, smtp_port):
+    """Run one round of a scenario as a single user"""
+    if scenario in ('direct_zip', 'direct_pdf'):
+        response = post_generate(client, metrics, roster, template, scenario.split('_')[1])
+        if response.status_code == 200:
+            metrics.add_certificates(rows)
+        else:
+            metrics.add_error(f"{scenario}: /generate returned {response.status_code}")
+        return
+
+    response = post_generate(client, metrics, roster, template)
+    if response.status_code != 302:
+        metrics.add_error(f"{scenario}: /generate returned {response.status_code}")
+        return
+    session_id, certificate_files = get_certificate_files(client)
+    metrics.add_certificates(len(certificate_files))
+
+    if scenario == 'preview':
+        timed_request(metrics, 'GET /preview', lambda: client.get('/preview'))
+        # Load every thumbnail, then revisit the page the way a browser would
+        etags = {}
+        for filename in certificate_files:
+            url = f'/static/generated/{session_id}/{filename}'
+            image = timed_request(metrics, 'GET certificate', lambda: client.get(url))
+            etags[url] = image.headers.get('ETag')
+        for url, etag in etags.items():
+            headers = {'If-None-Match': etag} if etag else {}
+            timed_request(metrics, 'GET certificate (revalidate)', lambda: client.get(url, headers=headers))
+        client.get('/clear_session')
+    elif scenario in ('download_zip', 'download_pdf'):
+        download_format = scenario.split('_')[1]
+        timed_request(metrics, f'GET /download ({download_format})',
+                      lambda: client.get(f'/download?format={download_format}'))
+    elif scenario == 'send_emails':
+        timed_request(metrics, 'POST /send_emails', lambda: client.post('/send_emails', data={
+            'sender_email': 'coordinator@example.org',
+            'sender_password': 'load-test',
+            'smtp_host': '127.0.0.1',
+            'smtp_port': str(smtp_port),
+            'subject': 'Your Certificate',
+            'body': 'Please find your certificate attached.',
+        }))
+        client.get('/clear_session')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_scenario(scenario, args, template, sink):
+    """Run a scenario with args.users concurrent users and return its results"""
+    metrics = Metrics()
+    rosters = [make_roster(args.rows, seed) for seed in range(args.users)]
+    messages_before = sink.messages if sink else 0
+    smtp_port = sink.server_address[1] if sink else 0
+
+    def user(index):
+        client = certificate_app.app.test_client()
+        for _ in range(args.rounds):
+            try:
+                run_user(scenario, client, metrics, rosters[index], template, args.rows, smtp_port)
+            except Exception as e:
+                metrics.add_error(f"{scenario}: {e}")
+
+    sampler = ResourceSampler(certificate_app.GENERATED_FOLDER)
+    sampler.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(i,)) for i in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    sampler.stop()
+
+    requests_sent = sum(len(values) for values in metrics.latencies.values())
+    return {
+        'scenario': scenario,
+        'users': args.users,
+        'rows': args.rows,
+        'rounds': args.rounds,
+        'seconds': round(elapsed, 3),
+        'certificates': metrics.certificates,
+        'certificates_per_second': round(metrics.certificates / elapsed, 2) if elapsed else 0,
+        'requests': requests_sent,
+        'requests_per_second': round(requests_sent / elapsed, 2) if elapsed else 0,
+        'throttled_429': metrics.throttled,
+        'endpoints': {
+            label: {
+                'count': len(values),
+                'statuses': metrics.statuses[label],
+                'p50': round(percentile(values, 0.50), 4),
+                'p95': round(percentile(values, 0.95), 4),
+                'p99': round(percentile(values, 0.99), 4),
+                'max': round(max(values), 4),
+            }
+            for label, values in metrics.latencies.items()
+        },
+        'peak_rss_bytes': sampler.peak_rss,
+        'peak_generated_bytes': sampler.peak_disk,
+        'final_generated_bytes': get_folder_bytes(certificate_app.GENERATED_FOLDER),
+        'emails_received': (sink.messages - messages_before) if sink else None,
+        'errors': metrics.errors[:20],
+    }
+
+
+def print_result(result):
+    mb = 1024 * 1024
+    print(f"\n== {result['scenario']}: {result['users']} users x {result['rounds']} rounds x {result['rows']} rows ==")
+    print(f"  {result['certificates']} certificates in {result['seconds']:.2f}s "
+          f"({result['certificates_per_second']}/s), {result['requests']} requests "
+          f"({result['requests_per_second']}/s), {result['throttled_429']} throttled (429)")
+    print(f"  {'endpoint':<34}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  statuses")
+    for label, stats in sorted(result['endpoints'].items()):
+        print(f"  {label:<34}{stats['count']:>6}{stats['p50']:>9.3f}s{stats['p95']:>9.3f}s"
+              f"{stats['p99']:>9.3f}s{stats['max']:>9.3f}s  {stats['statuses']}")
+    print(f"  peak RSS {result['peak_rss_bytes'] / mb:.1f} MB, GENERATED_FOLDER peak "
+          f"{result['peak_generated_bytes'] / mb:.1f} MB, after {result['final_generated_bytes'] / mb:.1f} MB")
+    if result['emails_received'] is not None and result['scenario'] == 'send_emails':
+        print(f"  emails received by the SMTP sink: {result['emails_received']}")
+    for error in result['errors']:
+        print(f"  error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the certificate generator endpoints.')
+    parser.add_argument('--users', type=int, default=4, help='concurrent simulated users')
+    parser.add_argument('--rows', type=int, default=50, help='rows in each synthetic roster')
+    parser.add_argument('--rounds', type=int, default=2, help='batches each user runs per scenario')
+    parser.add_argument('--size', default='1000x700', help='template size in pixels, e.g. 3508x2480')
+    parser.add_argument('--scenario', default='all', choices=['all'] + SCENARIOS)
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    width, height = (int(value) for value in args.size.lower().split('x'))
+    template = make_template((width, height))
+
+    work_folder = tempfile.mkdtemp(prefix='certificate-load-test-')
+    # Keep generated certificates out of the project folder
+    certificate_app.GENERATED_FOLDER = os.path.join(work_folder, 'generated')
+    os.makedirs(certificate_app.GENERATED_FOLDER)
+    certificate_app.app.config['TESTING'] = True
+
+    scenarios = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    sink = start_smtp_sink(work_folder) if 'send_emails' in scenarios else None
+    if sink is None and 'send_emails' in scenarios:
+        scenarios.remove('send_emails')
+
+    results = []
+    try:
+        for scenario in scenarios:
+            result = run_scenario(scenario, args, template, sink)
+            print_result(result)
+            results.append(result)
+    finally:
+        if sink:
+            sink.shutdown()
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -63,7 +63,10 @@ canvas.addEventListener("click", function(e) {
                 history.push(`signature1_pos${posNumber}`);
             }
         } else {
-            layout[cleanField] = [x, y];
+            // A box makes the field auto-fit: the text shrinks until it fits inside it
+            const boxWidth = parseFloat(document.getElementById("boxWidth").value);
+            const boxHeight = parseFloat(document.getElementById("boxHeight").value);
+            layout[cleanField] = (boxWidth > 0 && boxHeight > 0) ? [x, y, boxWidth, boxHeight] : [x, y];
             history.push(cleanField);
         }
         redrawAll();
@@ -119,6 +122,39 @@ function saveLayout() {
     });
 }
 
+function runPreflight() {
+    const form = document.querySelector('form[action="/generate"]');
+    const result = document.getElementById("preflightResult");
+    result.style.display = "block";
+    result.textContent = "Checking...";
+
+    fetch('/preflight', {
+        method: "POST",
+        body: new FormData(form)
+    })
+    .then(res => res.json())
+    .then(data => {
+        if (data.status !== "success") {
+            result.style.color = "#721c24";
+            result.textContent = "Check failed: " + data.message;
+            return;
+        }
+        const lines = [];
+        lines.push(data.ok ? "✅ Ready to generate " + data.rows + " certificates." : "❌ Problems found in " + data.rows + " rows.");
+        data.errors.forEach(msg => lines.push("Error: " + msg));
+        data.warnings.forEach(msg => lines.push("Warning: " + msg));
+        data.overflow.slice(0, 10).forEach(item => lines.push("Row " + item.row + " " + item.field + " \"" + item.value + "\": " + item.problem));
+        data.autofit.forEach(item => lines.push("Auto-fit " + item.field + ": font size " + item.min_font_size + " to " + item.max_font_size));
+        lines.push("Estimated time: " + data.estimate.render_seconds + "s, size: " + (data.estimate.output_bytes / 1048576).toFixed(1) + " MB");
+        result.style.color = data.ok ? "#155724" : "#721c24";
+        result.innerText = lines.join("\n");
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        result.textContent = "Error running the check. Please try again.";
+    });
+}
+
 function redrawAll() {
     if (currentImage) {
         ctx.clearRect(0, 0, canvas.width, canvas.height);
@@ -126,7 +162,7 @@ function redrawAll() {
         ctx.font = "20px Arial";
         ctx.fillStyle = "black";
         for (let key in layout) {
-            let [x, y] = layout[key];
+            let [x, y, boxWidth, boxHeight] = layout[key];
             if (key.startsWith('signature')) {
                 // Draw signature placeholder differently
                 ctx.fillStyle = "red";
@@ -146,6 +182,12 @@ function redrawAll() {
                 ctx.font = "20px Arial";
             } else {
                 ctx.fillText(key, x, y);
+                if (boxWidth && boxHeight) {
+                    // Auto-fit box, centered on the field position like the text
+                    ctx.setLineDash([6, 4]);
+                    ctx.strokeRect(x - boxWidth / 2, y - boxHeight / 2, boxWidth, boxHeight);
+                    ctx.setLineDash([]);
+                }
             }
         }
     }
@@ -165,9 +207,10 @@ window.addEventListener("click", function(e) {
 
 window.addEventListener('DOMContentLoaded', function() {
     // Restore layout if available
-    fetch('/static/uploads/layout.json')
+    fetch('/layout')
         .then(response => response.json())
-        .then(savedLayout => {
+        .then(data => {
+            const savedLayout = data.layout;
             let restored = false;
             for (let key in savedLayout) {
                 layout[key] = savedLayout[key];
@@ -179,7 +222,13 @@ window.addEventListener('DOMContentLoaded', function() {
                 const info = document.getElementById('restoredFieldsInfo');
                 if (info) {
                     info.style.display = 'block';
-                    info.textContent = 'Previously added fields have been restored. You can add more fields below.';
+                    if (data.shared) {
+                        // Layouts are kept per browser session, so this browser has none of its own yet
+                        info.style.color = '#856404';
+                        info.textContent = 'No layout has been saved in this browser yet, so the shared default layout was loaded. Layouts are saved per browser: clearing cookies or switching browsers starts again from the default.';
+                    } else {
+                        info.textContent = 'Previously added fields have been restored. You can add more fields below.';
+                    }
                 }
             }
         })